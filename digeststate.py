@@ -0,0 +1,35 @@
+""" Remembers a fingerprint of what each recipient was last sent, so that unchanged digests
+    needn't be sent again every day """
+
+import hashlib
+import json
+import time
+from jsonstore import DAY, JsonStore
+
+def fingerprint(rows):
+    """ Hash of a recipient's digest rows. Rows should leave out anything, like ages, that
+        changes every day without anything having happened. """
+    data = json.dumps(sorted(rows), sort_keys=True, ensure_ascii=True)
+    return hashlib.sha1(data.encode('ascii')).hexdigest()
+
+class DigestState(JsonStore):
+    """ Maps recipient -> (fingerprint, time last sent), persisted as json. """
+
+    def __init__(self, path, force_days=7):
+        JsonStore.__init__(self, path)
+        # Allow half a day's slack, so a daily run that starts a little earlier than the last
+        # one doesn't push the forced resend back a whole day
+        self.force = force_days * DAY - DAY / 2
+
+    def unchanged(self, recipient, digest):
+        """ Whether recipient was sent this same digest recently enough not to need it again. """
+        if not self.path:
+            return False
+        entry = self.entries.get(recipient)
+        return bool(entry) and entry['digest'] == digest and \
+               time.time() - entry['sent'] < self.force
+
+    def sent(self, recipient, digest):
+        """ Record that recipient has just been sent digest. """
+        if self.path:
+            self.set(recipient, {'digest': digest, 'sent': time.time()})
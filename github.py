@@ -3,13 +3,90 @@
 """ Simple Python api to github. Based on code at https://github.com/litl/leeroy """
 
 import logging
+import random
+import time
 from flask import json
 import requests
+from requests.adapters import HTTPAdapter
 
 GITHUB_BASE = "https://api.github.com"
 GITHUB_COMMENT_URL = GITHUB_BASE + "/repos/{owner}/{repo_name}/issues/{number}/comments"
 GITHUB_HOOKS_URL = GITHUB_BASE + "/repos/{owner}/{repo_name}/hooks"
 
+CONNECT_TIMEOUT = 5     # seconds
+READ_TIMEOUT = 30       # seconds
+MAX_RETRIES = 3         # extra attempts for idempotent calls only
+RETRY_BACKOFF = 0.5     # seconds, doubled on each attempt and jittered
+RETRY_STATUS = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+class GitHubTransport(object):
+    """ Shared keep-alive session for all github calls, with timeouts and bounded retry. """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stats = {}
+
+    def _record(self, method, elapsed, retried, failed):
+        # calls, retries, failures, total seconds, slowest call
+        stats = self.stats.setdefault(method, [0, 0, 0, 0.0, 0.0])
+        stats[0] += 1
+        if retried:
+            stats[1] += 1
+        if failed:
+            stats[2] += 1
+        stats[3] += elapsed
+        stats[4] = max(stats[4], elapsed)
+
+    def request(self, method, url, **kwargs):
+        """ Issue a request, retrying idempotent ones on connection errors and 5xx replies. """
+        method = method.upper()
+        attempts = 1 + (self.max_retries if method in IDEMPOTENT_METHODS else 0)
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(method, time.time() - start, attempt > 0, True)
+                if attempt + 1 >= attempts:
+                    raise
+                logging.warn("GitHub %s %s failed, retrying", method, url)
+            else:
+                failed = response.status_code in RETRY_STATUS
+                self._record(method, time.time() - start, attempt > 0, failed)
+                if not failed or attempt + 1 >= attempts:
+                    return response
+                logging.warn("GitHub %s %s returned %s, retrying",
+                             method, url, response.status_code)
+            attempt += 1
+            time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def get(self, url, **kwargs):
+        """ GET a github url. """
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """ POST to a github url. Never retried, as it is not idempotent. """
+        return self.request('POST', url, **kwargs)
+
+    def report(self):
+        """ Summarise latency and retry statistics, one line per http method. """
+        lines = []
+        for method in sorted(self.stats):
+            calls, retries, failures, total, slowest = self.stats[method]
+            lines.append("%-7s calls=%d retries=%d failures=%d avg=%.3fs max=%.3fs" % (
+                method, calls, retries, failures, total / calls, slowest))
+        return '\n'.join(lines)
+
+transport = GitHubTransport()
+
 def get_repo_name(pull_request, key):
     """ Extract repo name from a pull request dict. """
     return pull_request[key]["repo"]["name"]
@@ -19,15 +96,18 @@ def update_pull_request(number, comment, repo_owner, repo_name, auth):
     url = GITHUB_COMMENT_URL.format(owner=repo_owner, repo_name=repo_name, number=number)
     params = dict(body=comment)
     headers = {"Content-Type": "application/json"}
-    requests.post(url,
-                  auth=auth,
-                  data=json.dumps(params),
-                  headers=headers)
+    response = transport.post(url,
+                              auth=auth,
+                              data=json.dumps(params),
+                              headers=headers)
+    if not response.ok:
+        logging.error("Unable to comment on pull request %s/%s#%s: %s",
+                      repo_owner, repo_name, number, response.status_code)
 
 def register_github_hooks(repo_name, repo_owner, auth, endpoint):
     """ Register hooks with github. Auth needs appropriate access to be allowed to do so. """
     url = GITHUB_HOOKS_URL.format(owner=repo_owner, repo_name=repo_name)
-    response = requests.get(url, auth=auth)
+    response = transport.get(url, auth=auth)
 
     if not response.ok:
         logging.warn("Unable to install GitHub hook for repo %s (%s): %s %s",
@@ -35,7 +115,7 @@ def register_github_hooks(repo_name, repo_owner, auth, endpoint):
         return
 
     found_hook = False
-    for hook in response.json:
+    for hook in response.json():
         if hook["name"] != "web":
             continue
 
@@ -50,10 +130,10 @@ def register_github_hooks(repo_name, repo_owner, auth, endpoint):
                   "events": ["pull_request"]}
         headers = {"Content-Type": "application/json"}
 
-        response = requests.post(url,
-                                 auth=auth,
-                                 data=json.dumps(params),
-                                 headers=headers)
+        response = transport.post(url,
+                                  auth=auth,
+                                  data=json.dumps(params),
+                                  headers=headers)
 
         if response.ok:
             logging.info("Registered github hook for %s", repo_name)
@@ -1,7 +1,8 @@
 #!/usr/bin/python
-""" Generate and optionally email information about JIRA issues stuck in'Discussing' state"""
+""" Generate and optionally email information about JIRA issues stuck in 'Discussing' (or other
+    configured) states"""
 
-import json
+import argparse
 from collections import namedtuple
 import smtplib
 from email.mime.multipart import MIMEMultipart
@@ -9,14 +10,86 @@ from email.mime.text import MIMEText
 from datetime import datetime
 import ConfigParser
 import os
+import time
 import requests
+import digeststate
+import jsonstream
+import profiling
 
-Summary = namedtuple('Summary', 'key, title, owner, creator, age, lastmod, security')
+Summary = namedtuple('Summary',
+                     'key, title, owner, creator, age, lastmod, security, status, assigned')
+Report = namedtuple('Report', 'name, title, statuses, unassigned, idle')
+
+# Used if issues.ini doesn't define any [report ...] sections
+DEFAULT_REPORT = Report(name='discussing', title='awaiting discussion',
+                        statuses=('discussing',), unassigned=False, idle=0)
+
+# Only ask Jira for the fields that go into a Summary
+SEARCH_FIELDS = 'summary,reporter,assignee,created,updated,security,status'
+SEARCH_PAGE_SIZE = 50
+
+HTML_TEMPLATE = """\
+<html>
+    <head>
+    <style>
+    table { 
+    color: #333; /* Lighten up font color */
+    font-family: Helvetica, Arial, sans-serif; /* Nicer font */
+    width: 100%%;
+    border-collapse: 
+    collapse; border-spacing: 0; 
+    }
+    td, th { border: 1px solid #CCC; height: 30px; } /* Make cells a bit taller */
+    th {
+    background: #F3F3F3; /* Light grey background */
+    font-weight: bold; /* Make sure they're bold */
+    }
+
+    td {
+    background: #FAFAFA; /* Lighter grey background */
+    text-align: center;
+    padding-left: 10px;
+    padding-right: 10px;
+    }
+    .leftaligned {
+    text-align: left;
+    }
+
+    </style>   
+    </head>
+    <body>
+%s
+    </body>
+</html>"""
+
+REPORT_HTML_TEMPLATE = """\
+    <p>The following Jira tickets appear to be waiting for your atttention:</p>
+    <p>
+    <table>
+        <tr><th>Key</th><th>Title</th><th>Owner</th><th>Creator</th><th>Age</th><th>Stalled for</th></tr>
+        %s
+    </table>
+    </p>
+    <p>The following Jira tickets created by you appear to be awaiting attention from someone else:</p>
+    <p>
+    <table>
+        <tr><th>Key</th><th>Title</th><th>Owner</th><th>Creator</th><th>Age</th><th>Stalled for</th></tr>
+        %s
+    </table>
+    </p>
+    <p>The full list of Jira tickets %s is as follows:</p>
+    <p>
+    <table>
+        <tr><th>Key</th><th>Title</th><th>Owner</th><th>Creator</th><th>Age</th><th>Stalled for</th></tr>
+        %s
+    </table>
+    </p>
+"""
 
 class JiraIssueReporter(object):
     """ Main class for generating Jira issue reports. """
 
-    def __init__(self):
+    def __init__(self, profiler=None):
 
         def _read_config(config, section, name, default):
             if config.has_option(section, name):
@@ -57,6 +130,34 @@ class JiraIssueReporter(object):
             for user in config.items('emails'):
                 self.emails[user[0]] = user[1]
 
+        self.digests = digeststate.DigestState(
+            _read_config(config, "options", "digestState", None),
+            int(_read_config(config, "options", "forceSendDays", 7)))
+
+        self.reports = []
+        for section in config.sections():
+            if section.startswith('report '):
+                name = section[len('report '):].strip()
+                statuses = tuple(status.strip().lower() for status in
+                                 _read_config(config, section, "status", "").split(',')
+                                 if status.strip())
+                if not statuses:
+                    raise RuntimeError("issues.ini report %s has no status" % name)
+                self.reports.append(Report(
+                    name=name,
+                    title=_read_config(config, section, "title", name),
+                    statuses=statuses,
+                    unassigned=_read_config_bool(config, section, "unassigned", False),
+                    idle=int(_read_config(config, section, "idle", 0))))
+        if not self.reports:
+            self.reports.append(DEFAULT_REPORT)
+
+        self.profiler = profiler or profiling.Profiler()
+
+    def _parse_time(self, timestr):
+        with self.profiler.phase('parse_time'):
+            return datetime.strptime(timestr, "%Y-%m-%dT%H:%M:%S.%f+0000")
+
     def _check_security(self, user_id, security):
         if security:
             return self.emails[user_id].endswith('lexisnexis.com') or self.emails[user_id].endswith('lnssi.com')
@@ -88,154 +189,196 @@ class JiraIssueReporter(object):
        summary.age.days, summary.lastmod.days)
         return (summary_text, summary_html)
 
+    def _summarise(self, ticket, now):
+        fields = ticket['fields']
+        key = ticket['key']
+        updated = self._parse_time(fields['updated'])
+        created = self._parse_time(fields['created'])
+        creator = fields['reporter']['name']
+        if not self.specified_only:
+            self.emails[creator] = fields['reporter']['emailAddress']
+        if fields['assignee']:
+            owner = fields['assignee']['name']
+            if not self.specified_only:
+                self.emails[owner] = fields['assignee']['emailAddress']
+        else:
+            owner = creator
+        if fields.get('security'):
+            security = fields['security']['name']
+        else:
+            security = None
+        summary = fields['summary']
+        return Summary(key=key, title=summary, owner=owner, creator=creator,
+                       age=now - created, lastmod=now - updated,
+                       security=security, status=fields['status']['name'].lower(),
+                       assigned=bool(fields['assignee']))
+
+    def _build_jql(self):
+        """ One query covering every report. Reports that differ only in status share a clause. """
+        statuses = {}
+        for report in self.reports:
+            statuses.setdefault((report.unassigned, report.idle), set()).update(report.statuses)
+        clauses = []
+        for (unassigned, idle), names in sorted(statuses.items()):
+            clause = 'status in (%s)' % ', '.join('"%s"' % name for name in sorted(names))
+            if unassigned:
+                clause += ' AND assignee is EMPTY'
+            if idle:
+                clause += ' AND updated <= -%dd' % idle
+            clauses.append('(%s)' % clause)
+        return '%s ORDER BY key' % ' OR '.join(clauses)
+
+    @staticmethod
+    def _matches(report, summary):
+        return summary.status in report.statuses and \
+               not (report.unassigned and summary.assigned) and \
+               summary.lastmod.days >= report.idle
+
+    def classify(self, summaries):
+        """ Sort the fetched issues into the configured reports. An issue can be in several. """
+        return [(report, [summary for summary in summaries if self._matches(report, summary)])
+                for report in self.reports]
+
     def fetch_jira(self):
-        """ read JIRAs that are in "discuss" state. """
+        """ Read, once each, all the JIRAs that any of the configured reports are interested in. """
         summaries = []
         now = datetime.now()
         if self.jira_url:
             jira_session = requests.Session()
             if self.jira_user and self.jira_password:
                 jira_session.auth = (self.jira_user, self.jira_password)
-            retcode = jira_session.get(
-                "%s/rest/api/2/search?jql=status=Discussing" % self.jira_url)
-            if retcode.ok:
-                tickets = json.loads(retcode.text or retcode.content)
-                for ticket in tickets['issues']:
-                    fields = ticket['fields']
-                    key = ticket['key']
-                    updated = datetime.strptime(
-                        fields['updated'], "%Y-%m-%dT%H:%M:%S.%f+0000")
-                    created = datetime.strptime(
-                        fields['created'], "%Y-%m-%dT%H:%M:%S.%f+0000")
-                    creator = fields['reporter']['name']
-                    if not self.specified_only:
-                        self.emails[creator] = fields['reporter']['emailAddress']
-                    if fields['assignee']:
-                        owner = fields['assignee']['name']
-                        if not self.specified_only:
-                            self.emails[owner] = fields['assignee']['emailAddress']
-                    else:
-                        owner = creator
-                    if 'security' in fields:
-                        security = fields['security']['name']
-                    else:
-                        security = None
-                    summary = fields['summary']
-                    summaries.append(Summary(key=key, title=summary, owner=owner, creator=creator,
-                                             age=now - created, lastmod=now - updated,
-                                             security=security))
+            search_url = "%s/rest/api/2/search" % self.jira_url
+            params = {'jql': self._build_jql(), 'fields': SEARCH_FIELDS,
+                      'maxResults': SEARCH_PAGE_SIZE, 'startAt': 0}
+            if self.verbose:
+                print "Searching Jira for %s" % params['jql']
+            while True:
+                count = 0
+                header = {}
+                start = time.time()
+                retcode = jira_session.get(search_url, params=params, stream=True)
+                chunks = jsonstream.ByteCounter(retcode.iter_content(jsonstream.CHUNK_SIZE))
+                try:
+                    if not retcode.ok:
+                        print "Jira search failed: %s %s\n%s" % (
+                            retcode.status_code, retcode.reason, retcode.text)
+                        raise RuntimeError("Jira search failed (%s)" % retcode.status_code)
+                    # Issues are decoded one at a time as they arrive, not as a whole page
+                    for ticket in jsonstream.iter_array(chunks, 'issues', header):
+                        summaries.append(self._summarise(ticket, now))
+                        count += 1
+                finally:
+                    retcode.close()
+                    self.profiler.count_request(search_url, chunks.nbytes, time.time() - start)
+                params['startAt'] += count
+                # Jira may return fewer than we asked for per page, so go by the total. Should
+                # it come after the issues we won't have seen it, so stop at an empty page.
+                total = header.get('total')
+                if not count or (total is not None and params['startAt'] >= total):
+                    break
         return summaries
 
-    def send_emails(self, summaries):
-        """ Send out emails for all the summaries we created."""
-        if self.email_user and self.email_password and self.email_server:
-            gmail = smtplib.SMTP(self.email_server)
-            gmail.starttls()
-            gmail.login(self.email_user, self.email_password)
-        else:
-            gmail = None
-
-        # One email per person in the dictionary
-
-        for email in self.emails:
-            summary_text = ''
-            summary_html = ''
-            owner_text = ''
-            owner_html = ''
-            creator_text = ''
-            creator_html = ''
-            for summary in sorted(summaries, key=lambda x: x.key):
-                if self._check_security(email, summary.security):
+    def _generate_report(self, email, report, summaries, show_title):
+        """ Plain text and html for one report's section of the email sent to email. """
+        summary_text = ''
+        summary_html = ''
+        owner_text = ''
+        owner_html = ''
+        creator_text = ''
+        creator_html = ''
+        for summary in sorted(summaries, key=lambda x: x.key):
+            if self._check_security(email, summary.security):
+                with self.profiler.phase('output_row'):
                     text, html = self._output_row(summary)
-                    if summary.owner == email:
-                        owner_text += text
-                        owner_html += html
-                    elif summary.creator == email:
-                        creator_text += text
-                        creator_html += html
-                    summary_text += text
-                    summary_html += html
-
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = 'Pending Jira tickets summary'
-            msg['From'] = self.email_from
-            msg['To'] = self.emails[email]
-
-            # Generate plaintext email contents
-
-            text = ""
-            if owner_text:
-                text += """\
+                if summary.owner == email:
+                    owner_text += text
+                    owner_html += html
+                elif summary.creator == email:
+                    creator_text += text
+                    creator_html += html
+                summary_text += text
+                summary_html += html
+        if show_title and not summary_text:
+            return ('', '')
+
+        # Generate plaintext email contents
+
+        text = ""
+        if show_title:
+            text += "Jira tickets %s\n\n" % report.title
+        if owner_text:
+            text += """\
 The following Jira tickets appear to be waiting for your attention:
 %-12s %-12s %-12s %-5s %-5s %s
 %s
 """ % ('Key', 'Owner', 'Creator', 'Age', 'Idle', 'Title', owner_text)
-            if creator_text:
-                text += """\
+        if creator_text:
+            text += """\
+The following Jira tickets created by you appear to be awaiting attention from someone else:
 %-12s %-12s %-12s %-5s %-5s %s
 %s
 """ % ('Key', 'Owner', 'Creator', 'Age', 'Idle', 'Title', creator_text)
-            text += """\
-The full list of Jira tickets awaiting discussion is as follows:
+        text += """\
+The full list of Jira tickets %s is as follows:
 %-12s %-12s %-12s %-5s %-5s %s
 %s
-""" % ('Key', 'Owner', 'Creator', 'Age', 'Idle', 'Title', summary_text)
+""" % (report.title, 'Key', 'Owner', 'Creator', 'Age', 'Idle', 'Title', summary_text)
 
-            # Generate HTML email contents
+        # Generate HTML email contents
 
-            html = """\
-<html>
-    <head>
-    <style>
-    table { 
-    color: #333; /* Lighten up font color */
-    font-family: Helvetica, Arial, sans-serif; /* Nicer font */
-    width: 100%%;
-    border-collapse: 
-    collapse; border-spacing: 0; 
-    }
-    td, th { border: 1px solid #CCC; height: 30px; } /* Make cells a bit taller */
-    th {
-    background: #F3F3F3; /* Light grey background */
-    font-weight: bold; /* Make sure they're bold */
-    }
+        html = ""
+        if show_title:
+            html += "    <h3>Jira tickets %s</h3>\n" % report.title
+        html += REPORT_HTML_TEMPLATE % (owner_html, creator_html, report.title, summary_html)
+        return (text, html)
 
-    td {
-    background: #FAFAFA; /* Lighter grey background */
-    text-align: center;
-    padding-left: 10px;
-    padding-right: 10px;
-    }
-    .leftaligned {
-    text-align: left;
-    }
+    def send_emails(self, summaries):
+        """ Send out emails for all the summaries we created."""
+        if self.email_user and self.email_password and self.email_server:
+            with self.profiler.phase('smtp'):
+                gmail = smtplib.SMTP(self.email_server)
+                gmail.starttls()
+                gmail.login(self.email_user, self.email_password)
+        else:
+            gmail = None
 
-    </style>   
-    </head>
-    <body>
-    <p>The following Jira tickets appear to be waiting for your atttention:</p>
-    <p>
-    <table>
-        <tr><th>Key</th><th>Title</th><th>Owner</th><th>Creator</th><th>Age</th><th>Stalled for</th></tr>
-        %s
-    </table>
-    </p>
-    <p>The following Jira tickets created by you appear to be awaiting attention from someone else:</p>
-    <p>
-    <table>
-        <tr><th>Key</th><th>Title</th><th>Owner</th><th>Creator</th><th>Age</th><th>Stalled for</th></tr>
-        %s
-    </table>
-    </p>
-    <p>The full list of Jira tickets awaiting discussion is as follows:</p>
-    <p>
-    <table>
-        <tr><th>Key</th><th>Title</th><th>Owner</th><th>Creator</th><th>Age</th><th>Stalled for</th></tr>
-        %s
-    </table>
-    </p>
-    </body>
-</html>""" % (owner_html, creator_html, summary_html)
+        # One email per person in the dictionary, covering every report
+
+        reports = self.classify(summaries)
+        sent = 0
+        suppressed = 0
+        for email in self.emails:
+            # Skip anyone for whom nothing has changed since we last told them (ages and idle
+            # times excepted)
+            digest = digeststate.fingerprint(
+                [(report.name, summary.key, summary.title, summary.owner, summary.creator)
+                 for report, report_summaries in reports for summary in report_summaries
+                 if email in (summary.owner, summary.creator) and
+                 self._check_security(email, summary.security)])
+            if gmail and self.digests.unchanged(email, digest):
+                if self.verbose:
+                    print "Nothing new for %s" % self.emails[email]
+                suppressed += 1
+                continue
+
+            text = ''
+            html = ''
+            for report, report_summaries in reports:
+                report_text, report_html = self._generate_report(
+                    email, report, report_summaries, len(reports) > 1)
+                text += report_text
+                html += report_html
+            if not text:
+                # None of the reports has anything this user is allowed to see
+                if self.verbose:
+                    print "Nothing to report to %s" % self.emails[email]
+                continue
+            html = HTML_TEMPLATE % html
+
+            msg = MIMEMultipart('alternative')
+            msg['Subject'] = 'Pending Jira tickets summary'
+            msg['From'] = self.email_from
+            msg['To'] = self.emails[email]
 
             # And send the email
 
@@ -243,7 +386,10 @@ The full list of Jira tickets awaiting discussion is as follows:
             msg.attach(MIMEText(html, 'html'))
             print "Emailing %s" % msg['To']
             if gmail:
-                gmail.sendmail(msg['From'], msg['To'], msg.as_string())
+                with self.profiler.phase('smtp'):
+                    gmail.sendmail(msg['From'], msg['To'], msg.as_string())
+                self.digests.sent(email, digest)
+                sent += 1
             else:
                 print "No email server set"
                 if self.verbose:
@@ -252,12 +398,28 @@ The full list of Jira tickets awaiting discussion is as follows:
     # All done
 
         if gmail:
-            gmail.quit()
+            with self.profiler.phase('smtp'):
+                gmail.quit()
+            self.digests.save()
+            print "Sent %d Jira digests, suppressed %d unchanged" % (sent, suppressed)
 
 def _main():
-    reporter = JiraIssueReporter()
-    summaries = reporter.fetch_jira()
-    reporter.send_emails(summaries)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profile', action='store_true',
+                        help='print per-phase timings and http request counts at the end')
+    parser.add_argument('--profile-dump', metavar='FILE',
+                        help='also write cProfile data to FILE (implies --profile)')
+    args = parser.parse_args()
+    profiler = profiling.Profiler(args.profile, args.profile_dump)
+    profiler.start()
+    reporter = JiraIssueReporter(profiler)
+    try:
+        with profiler.phase('fetch_jira'):
+            summaries = reporter.fetch_jira()
+        reporter.send_emails(summaries)
+    finally:
+        profiler.stop()
+    profiler.report()
 
 if __name__ == '__main__':
     _main()
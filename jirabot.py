@@ -42,6 +42,11 @@ def jirabot():
 
     return "Hello World!"
 
+@app.route("/stats/github", methods=['GET'])
+def github_stats():
+    """ Reports latency and retry statistics for calls made to github. """
+    return github.transport.report() or "No GitHub calls made yet"
+
 def _main():
     global jira_auth
     global github_auth
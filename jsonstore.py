@@ -0,0 +1,36 @@
+""" Dictionaries persisted as json files, for state kept from one run to the next """
+
+import json
+import os
+
+DAY = 24 * 60 * 60
+
+class JsonStore(object):
+    """ Entries loaded from, and saved back to, a json file. A missing or corrupt file just
+        starts out empty, and a store without a path is never saved. """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path) as store:
+                    self.entries = json.load(store)
+            except ValueError:
+                self.entries = {}
+
+    def set(self, key, value):
+        """ Add or replace an entry. """
+        self.entries[key] = value
+        self.dirty = True
+
+    def save(self):
+        """ Write the entries back out, if anything changed. """
+        if not self.path or not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as store:
+            json.dump(self.entries, store, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+        self.dirty = False
@@ -0,0 +1,106 @@
+""" Incremental parsing of the (potentially large) json arrays returned by the Jira REST api.
+
+    Rather than holding the raw body, a decoded copy and the whole object tree in memory at
+    once, the response is scanned as it arrives and each element of the array is decoded on
+    its own as soon as its closing brace has been read. """
+
+import codecs
+import json
+import re
+
+CHUNK_SIZE = 16 * 1024
+
+_STRUCTURE_RE = re.compile(r'["\[\]{}]')
+_STRING_RE = re.compile(r'["\\]')
+
+def iter_array(chunks, key=None, header=None):
+    """ Yields each object in a json array from an iterable of utf-8 byte chunks. The array is
+        either the whole document or, if key is given, the value of that key in the top level
+        object. Anything outside the array is skipped without being decoded, and nothing more
+        is read once the array has been closed. If a header dict is passed along with key, it
+        is filled in with the top level fields that precede the array. """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = u''
+    pos = 0                 # next character to scan
+    depth = 0
+    in_string = False
+    string_start = None     # start of a top level key, while we are still looking for ours
+    last_key = None
+    array_depth = None      # depth inside the array, once we have found it
+    element_start = None
+    outer_depth = 0 if key is None else 1
+    for chunk in chunks:
+        buf += decoder.decode(chunk)
+        while True:
+            if in_string:
+                match = _STRING_RE.search(buf, pos)
+                if not match:
+                    pos = len(buf)
+                    break
+                if match.group() == '\\':
+                    if match.end() >= len(buf):
+                        pos = match.start()  # wait for the escaped character
+                        break
+                    pos = match.end() + 1
+                    continue
+                pos = match.end()
+                in_string = False
+                if string_start is not None:
+                    last_key = buf[string_start + 1:match.start()]
+                    string_start = None
+                continue
+            match = _STRUCTURE_RE.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                in_string = True
+                if array_depth is None and depth == outer_depth and key is not None:
+                    string_start = match.start()
+            elif char == '{' or char == '[':
+                if depth == array_depth and char == '{':
+                    element_start = match.start()
+                elif array_depth is None and char == '[' and depth == outer_depth and \
+                     (key is None or last_key == key):
+                    array_depth = depth + 1
+                    if header is not None and key is not None:
+                        # Nothing has been dropped yet, so this is the object up to our key
+                        header.update(json.loads(buf[:match.start()] + '[]}'))
+                depth += 1
+            else:
+                depth -= 1
+                if array_depth is not None:
+                    if depth < array_depth:
+                        return
+                    if depth == array_depth and element_start is not None:
+                        yield json.loads(buf[element_start:pos])
+                        element_start = None
+        # Drop everything we no longer need
+        if header is not None and key is not None and array_depth is None:
+            continue
+        keep = pos
+        if element_start is not None:
+            keep = min(keep, element_start)
+        if string_start is not None:
+            keep = min(keep, string_start)
+        if keep:
+            buf = buf[keep:]
+            pos -= keep
+            if element_start is not None:
+                element_start -= keep
+            if string_start is not None:
+                string_start -= keep
+
+class ByteCounter(object):
+    """ Wraps an iterable of byte chunks, counting the bytes as they go past. """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.nbytes = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.nbytes += len(chunk)
+            yield chunk
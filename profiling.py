@@ -0,0 +1,124 @@
+""" Lightweight per-phase timing and request accounting for the report scripts """
+
+import cProfile
+import re
+import sys
+import time
+
+_HOST_RE = re.compile(r'^https?://[^/]+')
+_REPO_RE = re.compile(r'/repos/[^/]+/[^/]+')
+_USER_RE = re.compile(r'/users/[^/]+')
+_ID_RE = re.compile(r'(?<!/api)/\d+(?=/|$)')  # but not the version in Jira's /rest/api/2
+
+def endpoint_pattern(url):
+    """ Reduce a request url to its endpoint, e.g. /repos/{repo}/issues/{n}/events """
+    path = _HOST_RE.sub('', url.split('?', 1)[0])
+    path = _REPO_RE.sub('/repos/{repo}', path)
+    path = _USER_RE.sub('/users/{login}', path)
+    return _ID_RE.sub('/{n}', path)
+
+class _NullPhase(object):
+    """ Stands in for a phase when profiling is disabled. """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase(object):
+    """ Times one pass through a named phase. """
+    __slots__ = ('profiler', 'name', 'repo', 'start')
+
+    def __init__(self, profiler, name, repo):
+        self.profiler = profiler
+        self.name = name
+        self.repo = repo
+        self.start = None
+
+    def __enter__(self):
+        if self.repo is not None:
+            self.profiler.repos.append(self.repo)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.time() - self.start
+        profiler = self.profiler
+        _add(profiler.phases, self.name, elapsed)
+        if profiler.repos:
+            _add(profiler.repo_phases, (profiler.repos[-1], self.name), elapsed)
+        if self.repo is not None:
+            profiler.repos.pop()
+        return False
+
+def _add(table, key, elapsed):
+    entry = table.setdefault(key, [0, 0.0])
+    entry[0] += 1
+    entry[1] += elapsed
+
+class Profiler(object):
+    """ Collects wall time and call counts per phase and per repository, plus http traffic
+        per endpoint. When disabled every method is a cheap no-op. """
+
+    def __init__(self, enabled=False, dump_file=None):
+        self.enabled = enabled or bool(dump_file)
+        self.dump_file = dump_file
+        self.phases = {}
+        self.repo_phases = {}
+        self.endpoints = {}
+        self.repos = []
+        self._cprofile = None
+        self._start = None
+
+    def phase(self, name, repo=None):
+        """ Context manager timing a phase. Passing repo attributes it, and any phases nested
+            inside it, to that repository. """
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name, repo)
+
+    def count_request(self, url, nbytes, elapsed):
+        """ Record one http request against its endpoint pattern. """
+        if self.enabled:
+            entry = self.endpoints.setdefault(endpoint_pattern(url), [0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += nbytes
+            entry[2] += elapsed
+
+    def start(self):
+        """ Start the run clock, and cProfile if a dump file was requested. """
+        self._start = time.time()
+        if self.dump_file:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        """ Stop timing, writing the cProfile dump if there is one. """
+        if self._cprofile:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.dump_file)
+            self._cprofile = None
+
+    def report(self, out=sys.stdout):
+        """ Print a compact timing table. Phase times are inclusive of nested phases. """
+        if not self.enabled:
+            return
+        if self._start is not None:
+            out.write("Total run time %.2fs\n" % (time.time() - self._start))
+        out.write("%-40s %8s %10s\n" % ('Phase', 'Calls', 'Seconds'))
+        for name, (calls, secs) in sorted(self.phases.items(), key=lambda x: -x[1][1]):
+            out.write("%-40s %8d %10.3f\n" % (name, calls, secs))
+        if self.repo_phases:
+            out.write("%-40s %8s %10s\n" % ('Repository / phase', 'Calls', 'Seconds'))
+            for (repo, name), (calls, secs) in sorted(self.repo_phases.items()):
+                out.write("%-40s %8d %10.3f\n" % ('%s / %s' % (repo, name), calls, secs))
+        if self.endpoints:
+            out.write("%-50s %8s %12s %10s\n" % ('Endpoint', 'Requests', 'Bytes', 'Seconds'))
+            for pattern, (count, nbytes, secs) in sorted(self.endpoints.items()):
+                out.write("%-50s %8d %12d %10.3f\n" % (pattern, count, nbytes, secs))
+        if self.dump_file:
+            out.write("cProfile data written to %s\n" % self.dump_file)
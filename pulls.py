@@ -1,9 +1,12 @@
 #!/usr/bin/python
 """ Generate and optionally email information about pending github pull requests"""
 
+import argparse
+import heapq
 import json
 import re
 import os
+import time
 from collections import namedtuple
 import smtplib
 from email.mime.multipart import MIMEMultipart
@@ -12,13 +15,39 @@ from datetime import datetime
 import ConfigParser
 import sys
 import requests
+import digeststate
+import profiling
+import userdirectory
 
-Summary = namedtuple('Summary', 'repo, id, url, ref, title, refs, owner, creator, age, lastmod')
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+GITHUB_USER_URL = "https://api.github.com/users/%s"
+USER_BATCH_SIZE = 50
+
+Summary = namedtuple('Summary',
+                     'repo, id, url, ref, title, refs, owner, creator, age, lastmod, assigned')
+
+# An @ inside an email address like john@example.com isn't a mention. A mention takes the
+# whole of a hyphenated login, but not a trailing hyphen.
+MENTION_RE = re.compile(r"(?<![\w.+-])@([A-Za-z0-9](?:-?[A-Za-z0-9])*)")
+Pull = namedtuple('Pull', 'number, url, ref, title, creator, created, lastmodified')
+
+class Event(object):
+    """ One entry in a pull request's timeline. """
+    __slots__ = ('actor', 'action', 'time')
+
+    def __init__(self, actor, action, event_time):
+        self.actor = actor
+        self.action = action
+        self.time = event_time
+
+def _keyed_by_time(index, events):
+    for event in events:
+        yield (event.time, index, event)
 
 class PullRequestReporter(object):
     """ Main class for generating pull request reports. """
 
-    def __init__(self):
+    def __init__(self, profiler=None):
 
         def _read_config(config, section, name, default):
             if config.has_option(section, name):
@@ -40,6 +69,7 @@ class PullRequestReporter(object):
         config.read('pulls.ini')
 
         self.verbose = _read_config_bool(config, "options", "verbose", False)
+        self.specified_only = _read_config_bool(config, "options", "specifiedOnly", True)
         self.email_user = _read_config(config, "email", "user", None)
         self.email_password = _read_config(config, "email", "password", None)
         self.email_server = _read_config(config, "email", "SMTP", None)
@@ -72,19 +102,103 @@ class PullRequestReporter(object):
         self.jira_regex = _read_config(config, "jira", "regex", None)
         self.jira_url = _read_config(config, "jira", "url", None)
 
+        self.users = userdirectory.UserDirectory(
+            _read_config(config, "options", "userCache", "github-users.json"),
+            int(_read_config(config, "options", "userCacheDays", 30)),
+            int(_read_config(config, "options", "userCacheMissingDays", 7)))
+        self.digests = digeststate.DigestState(
+            _read_config(config, "options", "digestState", None),
+            int(_read_config(config, "options", "forceSendDays", 7)))
+
         self.session = requests.Session()
         if self.github_user and self.github_password:
             # Unauthenticated will still work, but will hit github throttle limits
             # pretty quickly
             self.session.auth = (self.github_user, self.github_password)
+        self.profiler = profiler or profiling.Profiler()
+
+    def _get(self, url, **kwargs):
+        start = time.time()
+        retcode = self.session.get(url, **kwargs)
+        self.profiler.count_request(url, len(retcode.content), time.time() - start)
+        return retcode
+
+    def _get_records(self, url, **kwargs):
+        """ Returns the objects in the json array returned by url, or nothing if the request
+            fails. GitHub pages hold at most 30 records, so aren't worth streaming. """
+        retcode = self._get(url, **kwargs)
+        if not retcode.ok:
+            return []
+        return json.loads(retcode.text or retcode.content)
+
+    def _parse_time(self, timestr):
+        with self.profiler.phase('parse_time'):
+            return datetime.strptime(timestr, "%Y-%m-%dT%H:%M:%SZ")
 
     def _fetch_email(self, user_id):
         if user_id in self.emails:
             return self.emails[user_id]
         else:
-            # Too many false positives on the mentions to want to lookup users in
-            # github (and it's slow)
-            return None
+            # Looked up in github by _resolve_users, if at all
+            return self.users.email(user_id)
+
+    def _lookup_user(self, login):
+        retcode = self._get(GITHUB_USER_URL % login)
+        if retcode.status_code == 404:
+            self.users.put(login, False)
+        elif retcode.ok:
+            user = json.loads(retcode.text or retcode.content)
+            self.users.put(login, True, user.get('name'), user.get('email'))
+
+    def _lookup_user_batch(self, logins):
+        # GraphQL can look up a whole batch of users in one request, but only when authenticated.
+        # Logins have already been validated, so are safe to quote into the query.
+        query = 'query { %s }' % ' '.join(
+            'u%d: user(login: "%s") { name email }' % (index, login)
+            for index, login in enumerate(logins))
+        start = time.time()
+        retcode = self.session.post(GITHUB_GRAPHQL_URL, data=json.dumps({'query': query}))
+        self.profiler.count_request(GITHUB_GRAPHQL_URL, len(retcode.content), time.time() - start)
+        if not retcode.ok:
+            return
+        result = json.loads(retcode.text or retcode.content)
+        data = result.get('data')
+        if not data:
+            return
+        # Only treat a login as missing if github says so - other errors get retried next run
+        missing = set(error['path'][0] for error in result.get('errors', [])
+                      if error.get('type') == 'NOT_FOUND' and error.get('path'))
+        for index, login in enumerate(logins):
+            alias = 'u%d' % index
+            user = data.get(alias)
+            if user:
+                self.users.put(login, True, user.get('name'), user.get('email'))
+            elif alias in missing:
+                self.users.put(login, False)
+
+    def _resolve_users(self, summaries):
+        """ Look up, in as few requests as possible, any owners or creators we don't yet know. """
+        logins = set()
+        for row in summaries:
+            logins.add(row.owner)
+            logins.add(row.creator)
+        logins.difference_update(self.emails)
+        unseen = []
+        for login in self.users.unseen(logins):
+            if userdirectory.is_valid_login(login):
+                unseen.append(login)
+            else:
+                self.users.put(login, False)  # A false positive @mention
+        if self.verbose:
+            print "Looking up %d github users" % len(unseen)
+        with self.profiler.phase('resolve_users'):
+            if self.session.auth:
+                for start in range(0, len(unseen), USER_BATCH_SIZE):
+                    self._lookup_user_batch(unseen[start:start + USER_BATCH_SIZE])
+            else:
+                for login in unseen:
+                    self._lookup_user(login)
+        self.users.save()
 
     def _make_jira_link(self, instring):
         if self.jira_regex and self.jira_url:
@@ -119,124 +233,176 @@ class PullRequestReporter(object):
         return (summary_text, summary_html)
 
     def _fetch_events(self, github_repo, pull):
-        all_events = []
+        """ Yields the pull request's issue events, oldest first. """
         page = 1
         while True:
             events_url = "https://api.github.com/repos/%s/issues/%d/events?page=%d" % (
-                github_repo, pull['number'], page)
-            retcode = self.session.get(events_url, \
-                headers={'Accept':'application/vnd.github.black-cat-preview+json'})
-            events = json.loads(retcode.text or retcode.content)
+                github_repo, pull.number, page)
+            # Reduce the page to compact Events straight away, so the raw records can go
+            with self.profiler.phase('fetch_events'):
+                events = [Event(event['actor']['login'], event['event'],
+                                self._parse_time(event['created_at']))
+                          for event in self._get_records(events_url, \
+                              headers={'Accept':'application/vnd.github.black-cat-preview+json'})]
             if self.verbose:
                 print "Processing %d events" % len(events)
             for event in events:
-                actor = event['actor']['login']
-                action = event['event']
-                event_time = datetime.strptime(event['created_at'], "%Y-%m-%dT%H:%M:%SZ")
-                all_events.append((actor, action, event_time))
+                yield event
             if len(events) < 30:
                 break
             page += 1
-        return all_events
 
     def _fetch_reviews(self, github_repo, pull):
-        all_events = []
+        """ Returns (id, submitted time, mentions) for each submitted review, oldest first. """
+        all_reviews = []
         page = 1
         while True:
             reviews_url = "https://api.github.com/repos/%s/pulls/%d/reviews?page=%d" % (
-                github_repo, pull['number'], page)
-            retcode = self.session.get(reviews_url, \
-                headers={'Accept':'application/vnd.github.black-cat-preview+json'})
-            reviews = json.loads(retcode.text or retcode.content)
+                github_repo, pull.number, page)
+            count = 0
+            with self.profiler.phase('fetch_reviews'):
+                for review in self._get_records(reviews_url, \
+                        headers={'Accept':'application/vnd.github.black-cat-preview+json'}):
+                    count += 1
+                    if review.get('submitted_at'):  # Pending reviews have not been submitted yet
+                        all_reviews.append((review['id'],
+                                            self._parse_time(review['submitted_at']),
+                                            MENTION_RE.findall(review['body'] or '')))
+            if self.verbose:
+                print "Processing %d reviews" % count
+            if count < 30:
+                break
+            page += 1
+        # Reviews are listed in creation order, but one left pending can be submitted long after
+        # reviews created later than it, and the timeline merge relies on time order
+        all_reviews.sort(key=lambda x: x[1])
+        return all_reviews
+
+    @staticmethod
+    def _review_mentions(reviews):
+        for _, mention_time, mentions in reviews:
+            for mention in mentions:
+                yield Event(mention, "mentioned", mention_time)
+
+    def _fetch_review_comments(self, github_repo, pull, review_id):
+        """ Yields mentions in the comments on one review, oldest first. """
+        mentioned = []
+        page = 1
+        while True:
+            comments_url = \
+                "https://api.github.com/repos/%s/pulls/%d/reviews/%d/comments?page=%d" % \
+                (github_repo, pull.number, review_id, page)
+            count = 0
+            with self.profiler.phase('fetch_reviews'):
+                for comment in self._get_records(comments_url, \
+                        headers={'Accept':'application/vnd.github.black-cat-preview+json'}):
+                    count += 1
+                    mentions = MENTION_RE.findall(comment['body'])
+                    if mentions:
+                        mentioned.append((self._parse_time(comment['created_at']), mentions))
             if self.verbose:
-                print "Processing %d reviews" % len(reviews)
-            cpage = 1
-            for review in reviews:
-                body = review['body']
-                mentions = re.findall(r"@(\w+)", body)
-                mention_time = datetime.strptime(review['submitted_at'], "%Y-%m-%dT%H:%M:%SZ")
-                for mention in mentions:
-                    all_events.append((mention, "mentioned", mention_time))
-                # Comments on reviews can also have mentions in...
-                review_id = review['id']
-                comments_url = \
-                    "https://api.github.com/repos/%s/pulls/%d/reviews/%d/comments?page=%d" % \
-                    (github_repo, pull['number'], review_id, cpage)
-                retcode = self.session.get(comments_url, \
-                    headers={'Accept':'application/vnd.github.black-cat-preview+json'})
-                comments = json.loads(retcode.text or retcode.content)
-                if self.verbose:
-                    print "Processing %d review comments" % len(comments)
-                for comment in comments:
-                    body = comment['body']
-                    mentions = re.findall(r"@(\w+)", body)
-                    comment_time = datetime.strptime(comment['created_at'], "%Y-%m-%dT%H:%M:%SZ")
-                    if 'modified_at' in comment:
-                        comment_time = datetime.strptime(review.get('modified_at'),
-                                                         "%Y-%m-%dT%H:%M:%SZ")
-                    for mention in mentions:
-                        all_events.append((mention, "mentioned", comment_time))
-                if len(comments) < 30:
-                    break
-                cpage += 1
-            if len(reviews) < 30:
+                print "Processing %d review comments" % count
+            if count < 30:
                 break
             page += 1
-        return all_events
+        # Don't rely on the api's ordering - the timeline merge needs these in time order
+        mentioned.sort(key=lambda x: x[0])
+        for comment_time, mentions in mentioned:
+            for mention in mentions:
+                yield Event(mention, "mentioned", comment_time)
+
+    def _timeline(self, github_repo, pull):
+        """ Lazily merges all the pull request's event sources into one time ordered stream. """
+        reviews = self._fetch_reviews(github_repo, pull)
+        sources = [self._fetch_events(github_repo, pull), self._review_mentions(reviews)]
+        for review_id, _, _ in reviews:
+            sources.append(self._fetch_review_comments(github_repo, pull, review_id))
+        # Keyed on (time, source) so ties keep events ahead of reviews, and Events never compare
+        keyed = [_keyed_by_time(index, source) for index, source in enumerate(sources)]
+        for _, _, event in heapq.merge(*keyed):
+            yield event
+
+    def _resolve_owner(self, creator, timeline):
+        """ Replays a pull request's timeline to find its owner. Returns the owner, everyone
+            else involved in it (in order of first appearance), the time of the last event and
+            whether the owner was actually assigned (rather than just mentioned). """
+        owner = None
+        last_mentioned = None
+        lastevent = None
+        refs = [creator]
+        seen = set(refs)
+        for event in timeline:
+            actor = event.actor
+            action = event.action
+            if action == "unassigned":
+                owner = None
+            elif action == "assigned":
+                owner = actor
+            elif action == "mentioned":
+                last_mentioned = actor
+            if self.verbose:
+                print "Processing event %s %s" % (action, actor)
+            if actor not in seen:
+                seen.add(actor)
+                refs.append(actor)
+            lastevent = event.time
+        assigned = owner is not None
+        owner = owner or last_mentioned or creator
+        refs.remove(owner)
+        return owner, refs, lastevent, assigned
+
+    def _fetch_pulls(self, github_repo):
+        """ Returns the open pull requests, keeping only the fields we report on. """
+        pulls = []
+        for pull in self._get_records('https://api.github.com/repos/%s/pulls' % github_repo):
+            if self.pulls and not pull['number'] in self.pulls:
+                continue
+            created = self._parse_time(pull['created_at'])
+            if 'modified_at' in pull:
+                lastmodified = self._parse_time(pull.get('modified_at'))
+            else:
+                lastmodified = created
+            pulls.append(Pull(number=pull['number'], url=pull['html_url'],
+                              ref=pull['base']['ref'], title=pull['title'],
+                              creator=pull['user']['login'], created=created,
+                              lastmodified=lastmodified))
+        return pulls
 
     def _fetch_repo(self, repo_id, github_repo, summaries):
-        retcode = self.session.get('https://api.github.com/repos/%s/pulls' % github_repo)
-        if retcode.ok:
-            pulls = json.loads(retcode.text or retcode.content)
-            now = datetime.now()
+        pulls = self._fetch_pulls(github_repo)
+        now = datetime.now()
 
-            # loop through pull requests, gathering summary info into summaries
+        # loop through pull requests, gathering summary info into summaries
+        if self.verbose:
+            print "Processing %d pull requests" % len(pulls)
+        for pull in pulls:
             if self.verbose:
-                print "Processing %d pull requests" % len(pulls)
-            for pull in pulls:
-                if self.pulls and not pull['number'] in self.pulls:
-                    continue
-                if self.verbose:
-                    print "Processing pull request %s" % pull['number']
-                creator = pull['user']['login']
-                user_id_list = [creator]
-                created = datetime.strptime(pull['created_at'], "%Y-%m-%dT%H:%M:%SZ")
-                if 'modified_at' in pull:
-                    lastmodified = datetime.strptime(
-                        pull.get('modified_at'), "%Y-%m-%dT%H:%M:%SZ")
-                else:
-                    lastmodified = created
-                events = self._fetch_events(github_repo, pull) + \
-                         self._fetch_reviews(github_repo, pull)
-                events.sort(key=lambda x: x[2])  # Sort by event time
-                owner = None
-                last_mentioned = None
-                lastevent = created
-                for actor, action, lastevent in events:
-                    if action == "unassigned":
-                        owner = None
-                    elif action == "assigned":
-                        owner = actor
-                    elif action == "mentioned":
-                        last_mentioned = actor
-                    if self.verbose:
-                        print "Processing event %s %s" % (action, actor)
-                    if not actor in user_id_list:
-                        user_id_list.append(actor)
-                owner = owner or last_mentioned or creator
-                user_id_list.remove(owner)
-                if lastevent > lastmodified:
-                    lastmodified = lastevent
-                if self.verbose:
-                    print "Owner %s" % owner
-                summaries.append(Summary(repo=repo_id,
-                                         id=pull['number'], url=pull['html_url'],
-                                         ref=pull['base']['ref'], title=pull['title'],
-                                         refs=user_id_list, owner=owner,
-                                         creator=creator, age=now - created,
-                                         lastmod=now - lastmodified))
+                print "Processing pull request %s" % pull.number
+            owner, user_id_list, lastevent, assigned = self._resolve_owner(
+                pull.creator, self._timeline(github_repo, pull))
+            lastmodified = pull.lastmodified
+            if lastevent and lastevent > lastmodified:
+                lastmodified = lastevent
+            if self.verbose:
+                print "Owner %s" % owner
+            summaries.append(Summary(repo=repo_id,
+                                     id=pull.number, url=pull.url,
+                                     ref=pull.ref, title=pull.title,
+                                     refs=user_id_list, owner=owner,
+                                     creator=pull.creator, age=now - pull.created,
+                                     lastmod=now - lastmodified, assigned=assigned))
 
     def _generate_one(self, gmail, email, summaries):
+        # Skip the whole thing if nothing that concerns this user has changed since we last
+        # told them (ages and idle times excepted)
+        digest = digeststate.fingerprint(
+            [(row.repo, row.id, row.ref, row.title, row.owner, row.creator)
+             for row in summaries if email in (row.owner, row.creator)])
+        if gmail and self.digests.unchanged(email, digest):
+            if self.verbose:
+                print "Nothing new for %s" % email
+            return False
+
         summary_text = ''
         summary_html = ''
         owner_text = ''
@@ -244,7 +410,8 @@ class PullRequestReporter(object):
         creator_text = ''
         creator_html = ''
         for row in sorted(summaries, key=lambda x: x.ref):
-            text, html = self._output_row(row)
+            with self.profiler.phase('output_row'):
+                text, html = self._output_row(row)
             if row.owner == email:
                 owner_text += text
                 owner_html += html
@@ -257,7 +424,7 @@ class PullRequestReporter(object):
         msg = MIMEMultipart('alternative')
         msg['Subject'] = 'GitHub pull requests summary'
         msg['From'] = self.email_from
-        msg['To'] = self.emails[email]
+        msg['To'] = self._fetch_email(email)
 
         # Generate plaintext email contents
 
@@ -343,46 +510,77 @@ The full list of pull requests is as follows:
         if gmail:
             msg.attach(MIMEText(text, 'plain'))
             msg.attach(MIMEText(html, 'html'))
-            gmail.sendmail(msg['From'], msg['To'], msg.as_string())
+            with self.profiler.phase('smtp'):
+                gmail.sendmail(msg['From'], msg['To'], msg.as_string())
+            self.digests.sent(email, digest)
         else:
             print html
+        return True
 
     def generate_all(self, for_user=None):
         """ Generate and optionally email reports """
         summaries = []
         for repo in self.repositories:
-            self._fetch_repo(repo, self.repositories[repo], summaries)
+            with self.profiler.phase('fetch_repo', repo):
+                self._fetch_repo(repo, self.repositories[repo], summaries)
+        self._resolve_users(summaries)
 
         # Now send out emails
 
         if self.email_user and self.email_password and not for_user:
-            gmail = smtplib.SMTP(self.email_server)
-            gmail.starttls()
-            gmail.login(self.email_user, self.email_password)
+            with self.profiler.phase('smtp'):
+                gmail = smtplib.SMTP(self.email_server)
+                gmail.starttls()
+                gmail.login(self.email_user, self.email_password)
         else:
             gmail = None
 
         # One email per person in the dictionary
         if for_user:
-            if not for_user in self.emails:
-                raise RuntimeError("User %s not found in emails section" % for_user)
+            if not self._fetch_email(for_user):
+                raise RuntimeError("No email address known for user %s" % for_user)
             generate_for = [for_user]
         else:
-            generate_for = self.emails.keys()
+            generate_for = set(self.emails)
+            if not self.specified_only:
+                # Also anyone we found an address for who created or is assigned a pull
+                # request. Owners who were only mentioned may be a misreading of the comments.
+                for row in summaries:
+                    if self._fetch_email(row.creator):
+                        generate_for.add(row.creator)
+                    if row.assigned and self._fetch_email(row.owner):
+                        generate_for.add(row.owner)
+        sent = 0
         for email in generate_for:
-            self._generate_one(gmail, email, summaries)
+            if self._generate_one(gmail, email, summaries):
+                sent += 1
 
         # All done
 
         if gmail:
-            gmail.quit()
+            with self.profiler.phase('smtp'):
+                gmail.quit()
+            self.digests.save()
+            print "Sent %d pull request digests, suppressed %d unchanged" % (
+                sent, len(generate_for) - sent)
 
 def _main():
-    for_user = None
-    if len(sys.argv) > 1:
-        for_user = sys.argv[1]
-    reporter = PullRequestReporter()
-    reporter.generate_all(for_user)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('user', nargs='?',
+                        help='only generate (without emailing) the report for this user')
+    parser.add_argument('--profile', action='store_true',
+                        help='print per-phase timings and http request counts at the end')
+    parser.add_argument('--profile-dump', metavar='FILE',
+                        help='also write cProfile data to FILE (implies --profile)')
+    args = parser.parse_args()
+    profiler = profiling.Profiler(args.profile, args.profile_dump)
+    profiler.start()
+    reporter = PullRequestReporter(profiler)
+    try:
+        reporter.generate_all(args.user)
+    finally:
+        profiler.stop()
+    profiler.report()
 
 if __name__ == '__main__':
     _main()
@@ -0,0 +1,47 @@
+""" Persistent cache of GitHub user details, so each login is looked up at most once per ttl """
+
+import re
+import time
+from jsonstore import DAY, JsonStore
+
+# GitHub logins are alphanumeric plus single hyphens, at most 39 characters. Anything else
+# (e.g. an @some_word mention) can't be a user, so needn't be looked up at all.
+_LOGIN_RE = re.compile(r'^[A-Za-z0-9](?:[A-Za-z0-9]|-(?=[A-Za-z0-9])){0,38}$')
+
+def is_valid_login(login):
+    """ Whether login could possibly be a GitHub user name. """
+    return bool(_LOGIN_RE.match(login))
+
+class UserDirectory(JsonStore):
+    """ Maps login -> (name, email, exists), persisted as json. Logins that turned out not
+        to exist are cached too, with their own (usually shorter) time to live. """
+
+    def __init__(self, path, ttl_days=30, negative_ttl_days=7):
+        JsonStore.__init__(self, path)
+        self.ttl = ttl_days * DAY
+        self.negative_ttl = negative_ttl_days * DAY
+
+    def is_fresh(self, login, now=None):
+        """ Whether we have an entry for login that hasn't expired. """
+        entry = self.entries.get(login)
+        if entry is None:
+            return False
+        ttl = self.ttl if entry['exists'] else self.negative_ttl
+        return (now or time.time()) - entry['fetched'] < ttl
+
+    def unseen(self, logins):
+        """ The subset of logins that need looking up, sorted. """
+        now = time.time()
+        return sorted(login for login in set(logins) if not self.is_fresh(login, now))
+
+    def put(self, login, exists, name=None, email=None):
+        """ Record the result of looking up a login. """
+        self.set(login, {'exists': exists, 'name': name, 'email': email or None,
+                         'fetched': time.time()})
+
+    def email(self, login):
+        """ Email address for login if known. Stale entries are still used until refreshed. """
+        entry = self.entries.get(login)
+        if entry and entry['exists']:
+            return entry['email']
+        return None